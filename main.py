@@ -1,4 +1,5 @@
 import os
+import httpx
 from sanic import Sanic, Request, HTTPResponse
 from sanic.response import redirect, text, empty
 from httpx import HTTPError, NetworkError
@@ -51,6 +52,20 @@ NOTICE = """
     """
 
 
+@app.before_server_start
+async def create_http_client(app : Sanic, loop):
+    # A single client is shared across requests, so connections to Kies servers are kept alive.
+    app.ctx.http = httpx.AsyncClient(
+        http2 = True,
+        limits = httpx.Limits(max_keepalive_connections = 32, keepalive_expiry = 60)
+    )
+
+
+@app.after_server_stop
+async def close_http_client(app : Sanic, loop):
+    await app.ctx.http.aclose()
+
+
 @app.middleware("response")
 async def set_cors(request : Request, response : HTTPResponse):
     response.headers["Access-Control-Allow-Origin"] = request.app.config.SAMFETCH_ALLOW_ORIGIN
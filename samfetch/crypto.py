@@ -4,36 +4,25 @@ __all__ = [
 ]
 
 import base64
-from typing import Any, AsyncIterator, Generator, Optional, Tuple
+from typing import Any, AsyncIterator, Optional
 from Crypto.Cipher import AES
 from sanic.response import BaseHTTPResponse
 
 
-# has_next() function
-# https://stackoverflow.com/a/67428657
-# Licensed with CC BY-SA 4.0
-async def has_next(it) -> Generator[Tuple[bool, Any], None, None]:
-    first = True
-    async for e in it:
-        if not first:
-            yield True, prev
-        else:
-            first = False
-        prev = e
-    if not first:
-        yield False, prev
-
-
 async def start_decryptor(response : BaseHTTPResponse, iterator : AsyncIterator, key : Optional[bytes] = None, client : Optional[Any] = None):
     if key:
         cipher = AES.new(key, AES.MODE_ECB)
-        async for continues, chunk in has_next(iterator):
-            # Decrypt chunk
-            data = cipher.decrypt(chunk)
-            if continues:
-                await response.send(data)
-            else:
-                await response.send(Crypto.unpad(data))
+        tail = b""
+        async for chunk in iterator:
+            data = tail + chunk if tail else chunk
+            # ECB can only decrypt whole blocks, so the remainder is carried over to the next chunk.
+            # At least one block is always held back, as the last block needs to be unpadded.
+            keep = (len(data) % AES.block_size) or AES.block_size
+            if len(data) > keep:
+                await response.send(cipher.decrypt(memoryview(data)[:-keep]))
+            tail = data[-keep:]
+        if len(tail) == AES.block_size:
+            await response.send(Crypto.unpad(cipher.decrypt(tail)))
         if client:
             await client.aclose()
         await response.eof()
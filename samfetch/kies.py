@@ -10,14 +10,18 @@ __all__ = [
 
 from collections import UserDict
 from typing import List, Tuple, Dict, Any, Optional
-import dicttoxml
 import xmltodict
-import re
 import httpx
 import string
+import functools
 from samfetch.session import Session
 from .imei import generate_random_imei
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
 
 
 class IMEIGenerator:
@@ -28,17 +32,55 @@ class IMEIGenerator:
             return random_imei
 
 
+def _etree_to_kies(elem) -> Dict:
+    """
+    Converts a parsed XML element to a dictionary in the same shape that xmltodict outputs,
+    so existing key lookups (such as "#text" and "Data") keep working.
+    """
+    def _value(el) -> Any:
+        children = list(el)
+        text = el.text.strip() if el.text else None
+        if not children and not el.attrib:
+            return text or None
+        d = {f"@{k}": v for k, v in el.attrib.items()}
+        for child in children:
+            value = _value(child)
+            if child.tag in d:
+                if not isinstance(d[child.tag], list):
+                    d[child.tag] = [d[child.tag]]
+                d[child.tag].append(value)
+            else:
+                d[child.tag] = value
+        if text:
+            d["#text"] = text
+        return d
+    return {elem.tag: _value(elem)}
+
+
+def _parse_xml(xml : str) -> Dict:
+    """
+    Parses a Kies XML response with lxml, or with xmltodict if lxml is not installed.
+    """
+    if etree is not None:
+        return _etree_to_kies(etree.fromstring(xml.encode()))
+    return xmltodict.parse(
+        xml, dict_constructor=dict, process_namespaces=False, attr_prefix="@", cdata_key="#text"
+    )
+
+
 class KiesFirmwareList:
     """
     Parses firmware list.
     """
+    __slots__ = ("_data", "_versions")
+
     def __init__(self, data : Dict) -> None:
         self._data = data
         self._versions = None if ("versioninfo" not in self._data) else self._data["versioninfo"]["firmware"]["version"]
 
     @classmethod
     def from_xml(cls, xml : str) -> "KiesFirmwareList":
-        return cls(xmltodict.parse(xml, dict_constructor=dict))
+        return cls(_parse_xml(xml))
 
     @property
     def exists(self) -> bool:
@@ -71,12 +113,13 @@ class KiesDict(UserDict):
     """
     A dictionary object for reading values in KiesData.
     """
+    __slots__ = ()
+
     def __getitem__(self, key) -> Any:
-        d = super().__getitem__(key)
-        if type(d) is not dict:
-            return d
-        else:
-            return d.get("Data", d)
+        d = self.data[key]
+        if type(d) is dict and "Data" in d:
+            return d["Data"]
+        return d
 
     def get_first(self, *keys) -> Any:
         for key in keys:
@@ -88,12 +131,14 @@ class KiesData:
     """
     A class that holds Kies server responses.
     """
+    __slots__ = ("_data",)
+
     def __init__(self, data : Dict) -> None:
         self._data = data
 
     @classmethod
     def from_xml(cls, xml : str) -> "KiesData":
-        return cls(xmltodict.parse(xml, dict_constructor=dict))
+        return cls(_parse_xml(xml))
 
     @property
     def body(self) -> "KiesDict":
@@ -111,6 +156,40 @@ class KiesData:
     def session_id(self) -> str:
         return self._data["FUSMsg"]["FUSHdr"]["SessionID"]
 
+
+@functools.lru_cache(maxsize=2048)
+def _xmlescape_b(value : Any) -> bytes:
+    """
+    Converts a value to bytes that can be placed in XML text.
+    """
+    return str(value).encode().replace(b"&", b"&amp;").replace(b"<", b"&lt;").replace(b">", b"&gt;")
+
+
+_BINARY_INFO_TMPL = (
+    b"<FUSMsg><FUSHdr><ProtoVer>1.0</ProtoVer></FUSHdr><FUSBody><Put>"
+    b"<ACCESS_MODE><Data>2</Data></ACCESS_MODE>"
+    b"<BINARY_NATURE><Data>1</Data></BINARY_NATURE>"
+    b"<CLIENT_PRODUCT><Data>Smart Switch</Data></CLIENT_PRODUCT>"
+    b"<DEVICE_FW_VERSION><Data>%b</Data></DEVICE_FW_VERSION>"
+    b"<DEVICE_LOCAL_CODE><Data>%b</Data></DEVICE_LOCAL_CODE>"
+    b"<DEVICE_MODEL_NAME><Data>%b</Data></DEVICE_MODEL_NAME>"
+    b"<UPGRADE_VARIABLE><Data>0</Data></UPGRADE_VARIABLE>"
+    b"<OBEX_SUPPORT><Data>0</Data></OBEX_SUPPORT>"
+    b"<DEVICE_IMEI_PUSH><Data>%b</Data></DEVICE_IMEI_PUSH>"
+    b"<DEVICE_PLATFORM><Data>Android</Data></DEVICE_PLATFORM>"
+    b"<CLIENT_VERSION><Data>%b</Data></CLIENT_VERSION>"
+    b"<LOGIC_CHECK><Data>%b</Data></LOGIC_CHECK>"
+    b"</Put></FUSBody></FUSMsg>"
+)
+
+_BINARY_FILE_TMPL = (
+    b"<FUSMsg><FUSHdr><ProtoVer>1.0</ProtoVer></FUSHdr><FUSBody><Put>"
+    b"<BINARY_FILE_NAME><Data>%b</Data></BINARY_FILE_NAME>"
+    b"<LOGIC_CHECK><Data>%b</Data></LOGIC_CHECK>"
+    b"</Put></FUSBody></FUSMsg>"
+)
+
+
 class KiesConstants:
     """
     Constants for Kies server interactions.
@@ -124,7 +203,8 @@ class KiesConstants:
     HEADERS = lambda nonce=None, signature=None: \
         {
             "Authorization": f'FUS nonce="{nonce or ""}", signature="{signature or ""}", nc="", type="", realm="", newauth="1"',
-            "User-Agent": "Kies2.0_FUS"
+            "User-Agent": "Kies2.0_FUS",
+            "Accept-Encoding": "gzip, deflate"
         }
 
     COOKIES = lambda session_id=None: \
@@ -137,42 +217,20 @@ class KiesConstants:
 
 
     BINARY_INFO = lambda firmware_version, region, model, imei, logic_check: \
-        dicttoxml.dicttoxml({
-            "FUSMsg": {
-                "FUSHdr": {"ProtoVer": "1.0"},
-                "FUSBody": {
-                    "Put": {
-                        "ACCESS_MODE": {"Data": "2"},
-                        "BINARY_NATURE": {"Data": "1"},
-                        "CLIENT_PRODUCT": {"Data": "Smart Switch"},
-                        "DEVICE_FW_VERSION": {"Data": firmware_version},
-                        "DEVICE_LOCAL_CODE": {"Data": region},
-                        "DEVICE_MODEL_NAME": {"Data": model},
-                        "UPGRADE_VARIABLE":  {"Data": "0"},
-                        "OBEX_SUPPORT":  {"Data": "0"},
-                        "DEVICE_IMEI_PUSH": {"Data": imei},
-                        "DEVICE_PLATFORM": {"Data": "Android"},
-                        "CLIENT_VERSION": {"Data": KiesConstants.client_version},
-                        "LOGIC_CHECK": {"Data": logic_check}
-                    }
-                }
-            }
-        }, attr_type=False, root=False)
+        _BINARY_INFO_TMPL % (
+            _xmlescape_b(firmware_version),
+            _xmlescape_b(region),
+            _xmlescape_b(model),
+            _xmlescape_b(imei),
+            _xmlescape_b(KiesConstants.client_version),
+            _xmlescape_b(logic_check)
+        )
 
     BINARY_FILE = lambda filename, logic_check: \
-        dicttoxml.dicttoxml({
-            "FUSMsg": {
-                "FUSHdr": {"ProtoVer": "1.0"},
-                "FUSBody": {
-                    "Put": {
-                        "BINARY_FILE_NAME": {"Data": filename},
-                        "LOGIC_CHECK": {"Data": logic_check},
-#                         "DEVICE_IMEI_PUSH": {"Data": imei},
-#                         "CLIENT_VERSION": {"Data": KiesConstants.client_version}
-                    }
-                }
-            }
-        }, attr_type=False, root=False)
+        _BINARY_FILE_TMPL % (
+            _xmlescape_b(filename),
+            _xmlescape_b(logic_check)
+        )
 
 
 class KiesRequest:
@@ -191,7 +249,8 @@ class KiesRequest:
     def list_firmware(region: str, model: str) -> httpx.Request:
         return httpx.Request(
             "GET",
-            KiesConstants.GET_FIRMWARE_URL.format(region, model)
+            KiesConstants.GET_FIRMWARE_URL.format(region, model),
+            headers={"Accept-Encoding": "gzip, deflate"}
         )
 
 
@@ -211,7 +270,7 @@ class KiesRequest:
 
     @staticmethod
     def get_download(path: str, session: Session) -> httpx.Request:
-        filename = path.split("/")[-1]
+        filename = path.rsplit("/", 1)[-1]
         return httpx.Request(
             "POST",
             KiesConstants.BINARY_FILE_URL,
@@ -228,6 +287,8 @@ class KiesRequest:
     @staticmethod
     def start_download(path: str, session: Session, custom_range: str = None) -> httpx.Request:
         headers = KiesConstants.HEADERS(session.encrypted_nonce, session.auth)
+        # Firmware is streamed as raw bytes, so it must not be compressed.
+        headers["Accept-Encoding"] = "identity"
         if custom_range:
             headers["Range"] = custom_range
         return httpx.Request(
@@ -237,6 +298,14 @@ class KiesRequest:
             cookies=KiesConstants.COOKIES(session.session_id)
         )
 
+
+# Lookup tables for decoding the PDA part of firmware versions.
+_B36 = {c: i for i, c in enumerate(string.digits + string.ascii_uppercase)}
+_A_ORD = ord("A")
+_R_ORD = ord("R")
+_BL_PREFIXES = frozenset("US")
+
+
 class KiesUtils:
     """
     Utility functions for Kies server interactions.
@@ -244,7 +313,7 @@ class KiesUtils:
     @staticmethod
     def parse_firmware(firmware: str) -> str:
         if firmware:
-            l = firmware.split("/")
+            l = firmware.split("/", 3)
             if len(l) == 3:
                 l.append(l[0])
             if l[2] == "":
@@ -254,10 +323,10 @@ class KiesUtils:
 
     @staticmethod
     def parse_range_header(header: str) -> Tuple[int, int]:
-        ran = header.strip().removeprefix("bytes=").split("-", maxsplit=1)
-        if len(ran) != 2:
+        start, sep, end = header.strip().removeprefix("bytes=").partition("-")
+        if not sep:
             return -1, -1
-        return int(ran[0] or 0), int(ran[1] or 0)
+        return int(start or 0), int(end or 0)
 
     @staticmethod
     def join_path(*args, prefix="/") -> str:
@@ -268,21 +337,28 @@ class KiesUtils:
         return (prefix or "") + "/".join(paths)
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def read_firmware(firmware: str) -> Tuple[Optional[str], Optional[int], int, int, int]:
         if firmware.count("/") == 3:
-            pda = firmware.split("/")[0][-6:]
-            result = [None, None, None, None, None]
-            if (pda[0] in ["U", "S"]):
-                result[0] = pda[0:2]
-                result[1] = ord(pda[2]) - ord("A")
-                result[2] = (ord(pda[3]) - ord("R")) + 2018
-                result[3] = ord(pda[4]) - ord("A")
-                result[4] = (string.digits + string.ascii_uppercase).index(pda[5])
-            else:
-                result[2] = (ord(pda[-3]) - ord("R")) + 2018
-                result[3] = ord(pda[-2]) - ord("A")
-                result[4] = (string.digits + string.ascii_uppercase).index(pda[-1])
-            return result
+            pda = firmware[:firmware.find("/")][-6:]
+            try:
+                if pda[0] in _BL_PREFIXES:
+                    return (
+                        pda[0:2],
+                        ord(pda[2]) - _A_ORD,
+                        (ord(pda[3]) - _R_ORD) + 2018,
+                        ord(pda[4]) - _A_ORD,
+                        _B36[pda[5]]
+                    )
+                return (
+                    None,
+                    None,
+                    (ord(pda[-3]) - _R_ORD) + 2018,
+                    ord(pda[-2]) - _A_ORD,
+                    _B36[pda[-1]]
+                )
+            except KeyError:
+                pass
         raise ValueError("Invalid firmware format.")
 
     @staticmethod
@@ -1,37 +1,83 @@
 __all__ = ["bp"]
 
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from sanic import Blueprint
 from sanic.request import Request
-from sanic.response import json, redirect
+from sanic.response import json as sanic_json, redirect
 from sanic.exceptions import NotFound
 from samfetch.kies import KiesData, KiesFirmwareList, KiesRequest, KiesUtils, IMEIGenerator
 from samfetch.session import Session
 from samfetch.crypto import start_decryptor
 from web.exceptions import make_error, SamfetchError
 import httpx
+import asyncio
+import time
 import re
-import xml.etree.ElementTree as ET
 import csv
+import logging
+import orjson
+from urllib.parse import urlencode
 
 bp = Blueprint(name = "Routes")
+logger = logging.getLogger(__name__)
 
 
-@bp.get("/<region:str>/<model:str>/list")
-async def get_firmware_list(request : Request, region : str, model : str):
-    """
-    List the available firmware versions of a specified model and region.
-    """
-    client = httpx.AsyncClient()
+def json(body, **kwargs):
+    # Serialize with orjson, which is much faster than the standard json module.
+    return sanic_json(body, dumps = orjson.dumps, **kwargs)
+
+
+# Firmware versions are four "/" separated segments, such as "PDA/CSC/MODEM/BOOTLOADER".
+_FW_PATH_RE = re.compile(r"\A[A-Z0-9]+/[A-Z0-9]+/[A-Z0-9]+/[A-Z0-9]+\Z")
+
+# Firmware lists rarely change, so they are cached for a while per (region, model).
+_FW_LIST_TTL = 300
+_FW_LIST_CACHE : Dict[Tuple[str, str], Tuple[float, KiesFirmwareList]] = {}
+_FW_LIST_PENDING : Dict[Tuple[str, str], "asyncio.Future[KiesFirmwareList]"] = {}
+
+
+async def _fetch_firmware_list(client : httpx.AsyncClient, region : str, model : str) -> KiesFirmwareList:
     response = await client.send(
         KiesRequest.list_firmware(region = region, model = model)
     )
-    await client.aclose()
     # Raise exception when firmware list couldn't be fetched.
     if response.status_code != 200:
         raise make_error(SamfetchError.DEVICE_NOT_FOUND, response.status_code)
     # Parse XML
     firmwares = KiesFirmwareList.from_xml(response.text)
+    now = time.monotonic()
+    # Drop expired entries so the cache doesn't grow forever.
+    if len(_FW_LIST_CACHE) >= 1024:
+        for key in [k for k, (t, _) in _FW_LIST_CACHE.items() if now - t >= _FW_LIST_TTL]:
+            del _FW_LIST_CACHE[key]
+    _FW_LIST_CACHE[(region, model)] = (now, firmwares)
+    return firmwares
+
+
+async def _get_firmware_list(client : httpx.AsyncClient, region : str, model : str) -> KiesFirmwareList:
+    """
+    Returns the firmware list from cache, or fetches it from Kies servers.
+    Concurrent requests for the same device share a single upstream request.
+    """
+    key = (region, model)
+    cached = _FW_LIST_CACHE.get(key)
+    if cached and (time.monotonic() - cached[0] < _FW_LIST_TTL):
+        return cached[1]
+    pending = _FW_LIST_PENDING.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(_fetch_firmware_list(client, region, model))
+        _FW_LIST_PENDING[key] = pending
+        pending.add_done_callback(lambda _: _FW_LIST_PENDING.pop(key, None))
+    # Shield the shared request, so a cancelled caller doesn't cancel it for the others.
+    return await asyncio.shield(pending)
+
+
+@bp.get("/<region:str>/<model:str>/list")
+async def get_firmware_list(request : Request, region : str, model : str):
+    """
+    List the available firmware versions of a specified model and region.
+    """
+    firmwares = await _get_firmware_list(request.app.ctx.http, region, model)
 
     # Check if model is correct by checking the "versioninfo" key.
     if firmwares.exists:
@@ -53,64 +99,63 @@ async def get_firmware_list(request : Request, region : str, model : str):
         raise make_error(SamfetchError.FIRMWARE_LIST_EMPTY, 404)
     raise make_error(SamfetchError.FIRMWARE_CANT_PARSE, 404)
 
-request_imei = None
+
 @bp.get("/<region:str>/<model:str>/<mode:(latest|latest/download)>")
 async def get_firmware_latest(request : Request, region : str, model : str,  mode : str, imei: Optional[str] = None):
     """
     Gets the latest firmware version for the device and redirects to its information.
     """
-    # Create new session.
-    global global_imei
-    global_imei = request.args.get("imei", None)
-    client = httpx.AsyncClient()
-    response = await client.send(
-        KiesRequest.list_firmware(region = region, model = model)
-    )
-    await client.aclose()
-    # Raise exception when firmware list couldn't be fetched.
-    if response.status_code != 200:
-        raise make_error(SamfetchError.DEVICE_NOT_FOUND, response.status_code)
-    # Parse XML
-    firmwares = KiesFirmwareList.from_xml(response.text)
+    imei = request.args.get("imei", None)
+    firmwares = await _get_firmware_list(request.app.ctx.http, region, model)
     # Check if model is correct by checking the "versioninfo" key.
     if firmwares.exists:
-        return redirect(f"/{region}/{model}/{firmwares.latest}" + ("/download" if "/download" in mode else ""))
+        # Pass the IMEI to the firmware details endpoint, if one has been provided.
+        return redirect(
+            f"/{region}/{model}/{firmwares.latest}" + ("/download" if "/download" in mode else "") + \
+            ("" if imei is None else "?" + urlencode({"imei": imei}))
+        )
     # Raise exception when device couldn't be found.
     if firmwares._versions == None:
         raise make_error(SamfetchError.FIRMWARE_LIST_EMPTY, 404)
     raise make_error(SamfetchError.FIRMWARE_CANT_PARSE, 404)
 
 
-# read csv file
-def read_imei_data(csv_path, target_model):
-    with open(csv_path, newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            if target_model in row:
-                return row[0]  # Return the first element (IMEI) from the matching row
-    return None
+# Maps model names to their TAC, read from tacs.csv once on startup.
+_TAC_BY_MODEL : Dict[str, str] = {}
+
+
+@bp.before_server_start
+async def load_tacs(app, loop):
+    with open("web/tacs.csv", newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            for model in row[1:]:
+                # Keep the first matching row, like a top-down scan would.
+                _TAC_BY_MODEL.setdefault(model, row[0])
+
 
 # Gets the binary details such as filename and decrypt key.
 @bp.get("/<region:str>/<model:str>/<firmware_path:([A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*[/download]*)>")
 async def get_binary_details(request: Request, region: str, model: str, firmware_path: str, imei: Optional[str] = None):
+    request_imei = request.args.get("imei", None)
     # Check if "/download" path has been appended to the firmware value.
-    global global_imei
-    request_imei = global_imei
-    print("IMEI binary:", request_imei)
     is_download = firmware_path.removesuffix("/").endswith("/download")
     firmware = firmware_path.removesuffix("/").removesuffix("/download")
 
-    if not re.match(r"^[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*$", firmware):
+    if not _FW_PATH_RE.match(firmware):
         raise NotFound(f"Requested URL {request.path} not found")
 
     # Placeholder for defining imei before the loop.
     imei_data = None
     imei = None
     status_code = None
+    client : httpx.AsyncClient = request.app.ctx.http
     if request_imei is not None:
         imei_data = request_imei
     else:
-        imei_data = read_imei_data("web/tacs.csv", model)
+        imei_data = _TAC_BY_MODEL.get(model)
+    # Create new session.
+    nonce = await client.send(KiesRequest.get_nonce())
+    session = Session.from_response(nonce)
 
     # Use IMEIGenerator to generate a random IMEI
     for attempt in range(1, 6):
@@ -118,49 +163,45 @@ async def get_binary_details(request: Request, region: str, model: str, firmware
             imei = IMEIGenerator.generate_random_imei(imei_data)
         else:
             imei = imei_data
-            print("imei:", imei)
         # imei = "354399110859137"
 
-        # Create new session.
-        client = httpx.AsyncClient()
-        nonce = await client.send(KiesRequest.get_nonce())
-        session = Session.from_response(nonce)
-
-        try:
-            # Make the request with the generated IMEI
-            binary_info = await client.send(
-                KiesRequest.get_binary(region=region, model=model, firmware=firmware, imei=imei, session=session)
-            )
+        # Make the request with the generated IMEI
+        binary_info = await client.send(
+            KiesRequest.get_binary(region=region, model=model, firmware=firmware, imei=imei, session=session)
+        )
+        # Kies sends a new nonce with each response, so the session can be reused for the next attempt.
+        session.refresh_session(binary_info)
 
-            # Read the request.
-            root = ET.fromstring(binary_info.text)
-            status_code = root.find(".//Status").text
-            print("code status:", status_code)
+        # Read the request. The parsed data is kept for reading the binary details afterwards.
+        kies = KiesData.from_xml(binary_info.text)
+        status_code = kies.status_code
 
-            if status_code == "200":
-                break  # Break out of the loop when status_code is 200
+        if status_code == 200:
+            break  # Break out of the loop when status_code is 200
 
-            elif status_code == "408":
-                print(f"Attempt {attempt}: IMEI {imei} is invalid. FUS Returned : {status_code}")
-                # Handle 408 errors by waiting longer before retrying
+        elif status_code == 408:
+            logger.debug("Attempt %d: IMEI %s is invalid. FUS Returned : %d", attempt, imei, status_code)
+            # Handle 408 errors by waiting longer before retrying
 
-            elif status_code == "401":
-                # Handle 401 errors (Unauthorized) appropriately
-                raise make_error(SamfetchError.UNAUTHORIZED, int(status_code))
+        elif status_code == 401:
+            # Handle 401 errors (Unauthorized) appropriately
+            raise make_error(SamfetchError.UNAUTHORIZED, status_code)
 
-            else:
-                # Handle other non-200 status codes
-                raise make_error(SamfetchError.UNKNOWN_ERROR, int(status_code))
+        else:
+            # Handle other non-200 status codes
+            raise make_error(SamfetchError.UNKNOWN_ERROR, status_code)
 
-        finally:
-            await client.aclose()
 
+    if status_code == 200:
+        logger.debug("Attempt %d: Valid IMEI Found: %s", attempt, imei)
 
-    if status_code == "200":
-        kies = KiesData.from_xml(binary_info.text)
-        print(f"Attempt {attempt}: Valid IMEI Found: {imei}")
+        # Read the binary details once, as each access to kies.body builds a new KiesDict.
+        body = kies.body
+        binary_name = body["BINARY_NAME"]
+        model_path = body["MODEL_PATH"]
+        size = int(body["BINARY_BYTE_SIZE"])
 
-        ENCRYPT_VERSION = 4 if str(kies.body["BINARY_NAME"]).endswith("4") else 2
+        ENCRYPT_VERSION = 4 if str(binary_name).endswith("4") else 2
 
         # Generate decrypted key for decrypting the file after downloading.
         # Decrypt key gives a list of bytes, but as it is not possible to send as a query parameter,
@@ -169,13 +210,13 @@ async def get_binary_details(request: Request, region: str, model: str, firmware
             session.getv2key(firmware, model, region).hex()
             if ENCRYPT_VERSION == 2
             else session.getv4key(
-                kies.body.get_first("LATEST_FW_VERSION", "ADD_LATEST_FW_VERSION"),
-                kies.body["LOGIC_VALUE_FACTORY"],
+                body.get_first("LATEST_FW_VERSION", "ADD_LATEST_FW_VERSION"),
+                body["LOGIC_VALUE_FACTORY"],
             ).hex()
         )
 
         # If auto-downloading has enabled, redirect to downloading the firmware.
-        download_path = f'/file{kies.body["MODEL_PATH"]}{kies.body["BINARY_NAME"]}'
+        download_path = f'/file{model_path}{binary_name}'
         if is_download:
             return redirect(download_path + "?decrypt=" + decryption_key)
 
@@ -183,22 +224,20 @@ async def get_binary_details(request: Request, region: str, model: str, firmware
 
         # Get binary details.
         return json({
-            "display_name": kies.body["DEVICE_MODEL_DISPLAYNAME"],
-            "size": int(kies.body["BINARY_BYTE_SIZE"]),
-            "size_readable": "{:.2f} GB".format(
-                float(kies.body["BINARY_BYTE_SIZE"]) / 1024 / 1024 / 1024
-            ),
-            "filename": kies.body["BINARY_NAME"],
-            "path": kies.body["MODEL_PATH"],
-            "version": kies.body["CURRENT_OS_VERSION"].replace("(", " ("),
+            "display_name": body["DEVICE_MODEL_DISPLAYNAME"],
+            "size": size,
+            "size_readable": "{:.2f} GB".format(size / 1024 / 1024 / 1024),
+            "filename": binary_name,
+            "path": model_path,
+            "version": body["CURRENT_OS_VERSION"].replace("(", " ("),
             "encrypt_version": ENCRYPT_VERSION,
-            "last_modified": int(kies.body["LAST_MODIFIED"]),
+            "last_modified": int(body["LAST_MODIFIED"]),
             "decrypt_key": decryption_key,
-            "firmware_changelog_url": kies.body.get_first(
+            "firmware_changelog_url": body.get_first(
                 "DESCRIPTION", "ADD_DESCRIPTION"
             ),
-            "platform": kies.body["DEVICE_PLATFORM"],
-            "crc": kies.body["BINARY_CRC"],
+            "platform": body["DEVICE_PLATFORM"],
+            "crc": body["BINARY_CRC"],
             "download_path": server_path + download_path,
             "download_path_decrypt": (
                 server_path + download_path + "?decrypt=" + decryption_key
@@ -218,13 +257,12 @@ async def download_binary(request: Request, region: str, model: str,  firmware:
     To enable decrypting, insert "decrypt" query parameter with decryption key. If this parameter is not provided,
     the encrypted binary will be downloaded. Path, filename and decryption key can be obtained on `/firmware` endpoint.
     """
-    global filepath, p_filename
     args = request.get_args()
     decrypt_key = args.get("decrypt", None)
     DECRYPT_ENABLED : bool = decrypt_key != None
     CUSTOM_FILENAME : Optional[str] = None if "filename" not in args else str(args.get("filename")).removesuffix(".zip") + ".zip"
     # Create new session.
-    client = httpx.AsyncClient()
+    client : httpx.AsyncClient = request.app.ctx.http
     nonce = await client.send(KiesRequest.get_nonce())
     session = Session.from_response(nonce)
     # Make the request.
@@ -241,7 +279,6 @@ async def download_binary(request: Request, region: str, model: str,  firmware:
         kies = KiesData.from_xml(download_info.text)
         # Return error when binary couldn't be found.
         if kies.status_code != 200:
-            await client.aclose()
             raise make_error(SamfetchError.KIES_SERVER_ERROR, kies.status_code)
         # Else, make another request to get the binary.
         else:
@@ -249,7 +286,6 @@ async def download_binary(request: Request, region: str, model: str,  firmware:
             START_RANGE, END_RANGE = KiesUtils.parse_range_header(request.headers.get("Range", "bytes=0-"))
             # Check if range is invalid.
             if (START_RANGE == -1) or (END_RANGE == -1) or (DECRYPT_ENABLED and (END_RANGE != 0)):
-                await client.aclose()
                 raise make_error(SamfetchError.RANGE_HEADER_INVALID, 416)
             # Another request for streaming the firmware.
             download_file = await client.send(
@@ -263,38 +299,47 @@ async def download_binary(request: Request, region: str, model: str,  firmware:
             # Check if status code is not 200 or 206.
             if download_file.status_code not in [200, 206]:
                 # Raise HTTPException when status is not success.
-                await client.aclose()
+                await download_file.aclose()
                 raise make_error(SamfetchError.KIES_SERVER_ERROR, download_file.status_code)
             # Create headers.
-            # Create headers.
             headers = {
                 "Content-Disposition": 'attachment; filename="' + (CUSTOM_FILENAME or (filename if not DECRYPT_ENABLED else filename.replace(".enc4", "").replace(".enc2", ""))) + '"',
-                # Get the total size of binary.
-                "Content-Length": download_file.headers.get("Content-Length", ""),
                 "Accept-Ranges": "bytes",
                 "Connection": "keep-alive"
             }
-
-
             if "Content-Range" in download_file.headers:
                 headers["Content-Range"] = download_file.headers["Content-Range"]
-            # If decryption is enabled, remove Content-Length.
-            # Because when we decrypt the firmware, it becomes slightly bigger or smaller
+            # Report the total size of binary, if known.
+            # When decryption is enabled, Content-Length is not sent,
+            # because when we decrypt the firmware, it becomes slightly bigger or smaller
             # so this causes exceptions as Content-Length is not same as sent file size.
-            if DECRYPT_ENABLED:
-                del headers["Content-Length"]
-            # Decrypt bytes while downloading the file.
-            # So this way, we can directly serve the bytes to the client without downloading to the disk.
-            response = await request.respond(
-                headers = headers,
-                content_type = "application/zip" if DECRYPT_ENABLED else "application/octet-stream",
-                status = download_file.status_code
-            )
-            await start_decryptor(
-                response = response,
-                iterator = download_file.aiter_raw(chunk_size = request.app.config.SAMFETCH_CHUNK_SIZE),
-                key = None if not DECRYPT_ENABLED else bytes.fromhex(decrypt_key),
-                client = client
-            )
+            # Without Content-Length, the response is sent with chunked transfer encoding.
+            content_length = download_file.headers.get("Content-Length", None)
+            if (not DECRYPT_ENABLED) and content_length and content_length.isdigit():
+                headers["Content-Length"] = str(int(content_length))
+            chunk_size = request.app.config.SAMFETCH_CHUNK_SIZE
+            # The shared client stays open, only the streamed response is closed.
+            try:
+                response = await request.respond(
+                    headers = headers,
+                    content_type = "application/zip" if DECRYPT_ENABLED else "application/octet-stream",
+                    status = download_file.status_code
+                )
+                if DECRYPT_ENABLED:
+                    # Decrypt bytes while downloading the file.
+                    # So this way, we can directly serve the bytes to the client without downloading to the disk.
+                    await start_decryptor(
+                        response = response,
+                        iterator = download_file.aiter_raw(chunk_size = chunk_size),
+                        key = bytes.fromhex(decrypt_key)
+                    )
+                else:
+                    # Pass the encrypted bytes through as they are received.
+                    async for chunk in download_file.aiter_raw(chunk_size = chunk_size):
+                        await response.send(chunk)
+                    await response.eof()
+            finally:
+                await download_file.aclose()
+            return
     # Raise exception when status is not 200.
     raise make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, download_info.status_code)